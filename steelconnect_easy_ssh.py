@@ -10,6 +10,7 @@ Prerequisites:
 - requests module
 - steelconnection module
 Modules can be installed with 'pip3 install requests steelconnection'
+Optionally install orjson for faster JSON decoding on large realms.
 
 * = Windows 10 w/April 2018 supports OpenSSH, but still no nc/HTTP proxy
 support so SCM SSH tunnel won't work.
@@ -19,25 +20,72 @@ USAGE:
     Rename config.ini.example to config.ini to set SCM credentials, optional.
 
 """
+import concurrent.futures
 import configparser
+import functools
+import shlex
 import signal
 import socket
 import subprocess
 import sys
 import time
-from collections import namedtuple
+from collections import defaultdict, namedtuple
 import requests
 import steelconnection
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+Node = namedtuple('Node', ['site_name', 'site_id', 'node_id',
+                           'model', 'serial', 'org', 'uplinks'])
+
+# cache of prior responses per URL, so unchanged endpoints can be served
+# locally (TTL) or revalidated with a cheap 304 instead of refetched
+response_cache = {}
+# topology (orgs/sites/nodes) rarely changes, skip the network entirely
+# for this many seconds between menu refreshes
+CACHE_TTL = 60
+# fields the script actually reads per endpoint; everything else is
+# dropped right after decode so the cache and the menu code only hold
+# the handful of attributes they need instead of full SCM resources
+FIELDS_USED = {
+    ('config', 'orgs'): ('id', 'name'),
+    ('config', 'sites'): ('id', 'name'),
+    ('config', 'nodes'): ('id', 'site', 'org', 'model', 'serial'),
+    ('config', 'sshtunnel'): ('node_id',),
+    ('reporting', 'uplinks'): ('node', 'v4ip', 'v4ip_ext'),
+    ('reporting', 'nodes'): ('id', 'ha_state'),
+}
+# precomputed site-name suffixes for HA members, so the node loop never
+# builds these strings or calls capitalize()
+HA_SUFFIX = {'master': ' [HA Master]', 'backup': ' [HA Backup]'}
+# table header for list_nodes, built once instead of per menu redraw
+HEADER = "\n".join(("-"*104,
+                    "Id"+(" ")*4+"Organisation"+(" ")*24+"Site"+(" ")*32+"Model"+(" ")*5+"Serial",
+                    "-"*104))
+# row templates for list_nodes, so each row is one format() call on a
+# prebuilt template instead of re-evaluating a four-field f-string
+ROW_ACTIVE = "{index: <4}* {org: <35} {site_name: <35} {model: <9} {serial: <17}"
+ROW_INACTIVE = "{index: <5} {org: <35} {site_name: <35} {model: <9} {serial: <17}"
+
+
+@functools.lru_cache(maxsize=1)
+def load_config():
+    """Read SCM credentials from config.ini, None if absent/incomplete"""
+    config = configparser.ConfigParser()
+    config.read('config.ini')
+    try:
+        return config['SCM']['REALM'], config['SCM']['USERNAME'], config['SCM']['PASSWORD']
+    except KeyError:
+        return None
 
 
-config = configparser.ConfigParser()
-config.read('config.ini')
-try:
-    SCM_REALM = config['SCM']['REALM']
-    SCM_USER = config['SCM']['USERNAME']
-    SCM_PW = config['SCM']['PASSWORD']
-except KeyError:
-    print("config.ini file not found, please enter SCM details:")
+def configured_realm():
+    """Realm from config.ini, for use in error messages"""
+    credentials = load_config()
+    return credentials[0] if credentials else 'the SCM realm'
 
 
 def handle_error(function):
@@ -46,109 +94,197 @@ def handle_error(function):
         try:
             return function(*args, **kwargs)
         except requests.exceptions.RequestException:
-            print(f"Error: can't connect to SCM. Please verify config.ini or network connectivity.")
+            print("Error: can't connect to SCM. Please verify config.ini or network connectivity.")
             sys.exit(0)
         except steelconnection.exceptions.AuthenticationError:
-            print(f"401 Error: Incorrect username or password for {SCM_REALM}")
+            print(f"401 Error: Incorrect username or password for {configured_realm()}")
             sys.exit(0)
         except steelconnection.exceptions.APINotEnabled:
-            print(f"502 Error: REST API is not enabled on {SCM_REALM}")
+            print(f"502 Error: REST API is not enabled on {configured_realm()}")
             sys.exit(0)
     return handle_problems
 
 
+def get_cached(sc, api, items, ttl=0):
+    """Fetch items from SCM, using the local cache where possible.
+
+    Stores the ETag/Last-Modified headers per URL and sends them back on
+    the next request, so an unchanged endpoint answers with an empty 304
+    and the cached payload is reused. With a ttl the cached payload is
+    returned without touching the network at all for that many seconds.
+    """
+    url = f"https://{sc.realm}/api/scm.{api}/1.0/{items}"
+    cached = response_cache.get(url)
+    headers = {}
+    if cached:
+        if ttl and time.time() - cached['time'] < ttl:
+            return cached['payload']
+        if cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        if cached['last_modified']:
+            headers['If-Modified-Since'] = cached['last_modified']
+    response = sc.session.get(url, headers=headers, timeout=sc.timeout)
+    if cached and response.status_code == 304:
+        cached['time'] = time.time()
+        return cached['payload']
+    # keep steelconnection's status-code translation so handle_error can
+    # still tell auth/API failures apart from connectivity problems
+    if response.status_code == 401:
+        raise steelconnection.exceptions.AuthenticationError(f"401 Client Error: {url}")
+    if response.status_code == 502:
+        raise steelconnection.exceptions.APINotEnabled(f"502 Server Error: {url}")
+    response.raise_for_status()
+    # orjson decodes large nodes/uplinks payloads several times faster
+    # than stdlib json, fall back to response.json() when not installed
+    if orjson is not None:
+        payload = orjson.loads(response.content)
+    else:
+        payload = response.json()
+    if isinstance(payload, dict) and 'items' in payload:
+        payload = payload['items']
+    # SCM has no server-side field projection, so narrow the records here
+    fields = FIELDS_USED.get((api, items))
+    if fields and isinstance(payload, list):
+        payload = [{field: item.get(field) for field in fields} for item in payload]
+    response_cache[url] = {'etag': response.headers.get('ETag'),
+                           'last_modified': response.headers.get('Last-Modified'),
+                           'payload': payload, 'time': time.time()}
+    return payload
+
+
 @handle_error
-def get_items(sc, items):
+def get_items(sc, items, ttl=0):
     """Call SCM Config API for items"""
-    items = sc.get(items)
-    return items
+    return get_cached(sc, 'config', items, ttl)
 
 
 def getstatus_items(sc, items):
     """Call SCM Reporting API for items"""
-    items = sc.getstatus(items)
-    return items
+    return get_cached(sc, 'reporting', items)
 
 
 def get_org_details(orgs):
-    """Get node and site details, store in Org object"""
-    org_details = []
-    for org in orgs:
-        org_id = org['id']
-        org_name = org['name']
-        org_longname = org['longname']
-        Org = namedtuple('Org', ['org_id', 'org_name', 'org_longname'])
-        org_details.extend([Org(org_id, org_name, org_longname)])
-    return org_details
-
-
-def get_node_details(sc, sites, nodes, orgs, uplinks_status, nodes_status):
+    """Map org id to org name, for lookups in get_node_details"""
+    return {org['id']: org['name'] for org in orgs}
+
+
+def get_node_details(sc, sites, nodes, org_names, uplinks_status, nodes_status):
     """Put all relevant node, site, org and uplink info in Node object"""
     node_details = []
-    # Loop through all sites, get nodes per site, get org, uplinks per node
-    for site in sites:
-        for node in nodes:
-            if node['site'] == site['id']:
-                uplink_details = []
-                site_name = site['name']
-                site_id = site['id']
-                node_id = node['id']
-                model = sc.lookup.model(node['model'])
-                serial = node['serial'] or 'shadow'
-                for org in orgs:
-                    if node['org'] == org.org_id:
-                        org_name = org.org_name
-                        break
-                for uplink in uplinks_status:
-                    if node['id'] == uplink['node']:
-                        # store all valid uplink IPs
-                        if not ((uplink['v4ip_ext'] is None) or (uplink['v4ip_ext'] == '')):
-                            uplink_details.append(uplink['v4ip'])
-                            uplink_details.append(uplink['v4ip_ext'])
-                # this removes redundant IPs, in case v4ip == v4ip_ext
-                uplink_details = list(dict.fromkeys(uplink_details))
-                # if device is HA master/backup, add HA state to site name
-                for node_status in nodes_status:
-                    if node['id'] == node_status['id']:
-                        if ((node_status['ha_state'] == 'master') or
-                                (node_status['ha_state'] == 'backup')):
-                            ha_state_msg = " [HA " + node_status['ha_state'].capitalize() + "]"
-                            site_name = site_name + ha_state_msg
-                if serial != 'shadow' and "Xirrus" not in model:
-                    Node = namedtuple('Node', ['site_name', 'site_id', 'node_id',
-                                               'model', 'serial', 'org', 'uplinks'])
-                    node_details.extend([Node(site_name, site_id, node_id,
-                                              model, serial, org_name, uplink_details)])
-    # sort nodes by org + site_name, case-insensitive
-    node_details = sorted(node_details, key=lambda x: (x.org.casefold(), x.site_name.casefold()))
+    # index sites, orgs, uplinks and status by id once, so the node loop
+    # below does O(1) lookups instead of rescanning every list per node
+    sites_by_id = {site['id']: site for site in sites}
+    uplinks_by_node = defaultdict(list)
+    for uplink in uplinks_status:
+        # keep only the IP pair, the node loop reads nothing else
+        uplinks_by_node[uplink['node']].append((uplink['v4ip'], uplink['v4ip_ext']))
+    # only HA masters/backups matter below, filter the rest out up front
+    ha_by_node = {node_status['id']: node_status['ha_state']
+                  for node_status in nodes_status
+                  if node_status['ha_state'] in ('master', 'backup')}
+    # resolve each distinct model id once instead of once per node
+    model_by_id = {model_id: sc.lookup.model(model_id)
+                   for model_id in {node['model'] for node in nodes}}
+    # Loop through all nodes, get site, org, uplinks per node
+    for node in nodes:
+        site = sites_by_id.get(node['site'])
+        if site is None:
+            continue
+        # skip shadow appliances and Xirrus APs before doing any of the
+        # org/uplink/HA enrichment work below
+        serial = node['serial']
+        if not serial:
+            continue
+        model = model_by_id[node['model']]
+        if "Xirrus" in model:
+            continue
+        uplink_details = []
+        seen_ips = set()
+        site_name = site['name']
+        site_id = site['id']
+        node_id = node['id']
+        org_name = org_names.get(node['org'], '?')
+        for v4ip, v4ip_ext in uplinks_by_node[node_id]:
+            if not v4ip_ext:
+                continue
+            # store all valid uplink IPs, skipping redundant ones
+            # in case v4ip == v4ip_ext
+            for ip_addr in (v4ip, v4ip_ext):
+                if ip_addr and ip_addr not in seen_ips:
+                    seen_ips.add(ip_addr)
+                    uplink_details.append(ip_addr)
+        # if device is HA master/backup, add HA state to site name
+        ha_state = ha_by_node.get(node_id)
+        if ha_state:
+            site_name = site_name + HA_SUFFIX[ha_state]
+        node_details.append(Node(site_name, site_id, node_id,
+                                 model, serial, org_name, uplink_details))
+    # sort nodes by org + site_name, case-insensitive;
+    # decorate-sort-undecorate so each key is casefolded exactly once
+    keyed = [((node.org.casefold(), node.site_name.casefold()), node)
+             for node in node_details]
+    keyed.sort(key=lambda pair: pair[0])
+    node_details = [node for _, node in keyed]
     return node_details
 
 
 def list_nodes(node_details, active_tunnels):
     """ List all sites and nodes for user to select from in main() """
     tunnel_list = {}
-    print("-"*104)
-    print("Id"+(" ")*4+"Organisation"+(" ")*24+"Site"+(" ")*32+"Model"+(" ")*5+"Serial")
-    print("-"*104)
+    # one membership test per row instead of rescanning active_tunnels
+    active_node_ids = {active_tunnel['node_id'] for active_tunnel in active_tunnels}
+    lines = [HEADER]
     for index, node in enumerate(node_details, start=1):
-        for active_tunnel in active_tunnels:
-            if node.node_id == active_tunnel['node_id']:
-                print(f"{index: <4}* {node.org: <35} {node.site_name: <35}"
-                      f" {node.model: <9} {node.serial: <17}")
-                break
-        else:
-            print(f"{index: <5} {node.org: <35} {node.site_name: <35}"
-                  f" {node.model: <9} {node.serial: <17}")
+        row = ROW_ACTIVE if node.node_id in active_node_ids else ROW_INACTIVE
+        lines.append(row.format(index=index, org=node.org, site_name=node.site_name,
+                                model=node.model, serial=node.serial))
         tunnel_list[index] = {'node_id': node.node_id, 'site_id': node.site_id,
                               'name': node.site_name, 'uplinks': node.uplinks}
+    # emit the whole table in one write rather than one per row
+    print("\n".join(lines))
     return tunnel_list
 
 
+# node details reused between menu builds when only the tunnels changed
+menu_cache = {}
+
+
+def build_menu(sc, refresh='all'):
+    """Fetch SCM data and build the selectable node list.
+
+    refresh='all' fetches every endpoint (cheap when the response cache
+    can revalidate); refresh='tunnels' only refetches the sshtunnel list
+    and reuses the node details from the previous build.
+    """
+    if refresh == 'all' or 'node_details' not in menu_cache:
+        # the six GETs are independent, so fetch them concurrently and pay
+        # one round-trip instead of six; failures re-raise on .result()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=6) as executor:
+            futures = {'orgs': executor.submit(get_items, sc, 'orgs', CACHE_TTL),
+                       'sites': executor.submit(get_items, sc, 'sites', CACHE_TTL),
+                       'nodes': executor.submit(get_items, sc, 'nodes', CACHE_TTL),
+                       'uplinks_status': executor.submit(getstatus_items, sc, 'uplinks'),
+                       'nodes_status': executor.submit(getstatus_items, sc, 'nodes'),
+                       'sshtunnel': executor.submit(get_items, sc, 'sshtunnel')}
+        orgs = futures['orgs'].result()
+        sites = futures['sites'].result()
+        nodes = futures['nodes'].result()
+        uplinks_status = futures['uplinks_status'].result()
+        nodes_status = futures['nodes_status'].result()
+        active_tunnels = futures['sshtunnel'].result()
+        org_names = get_org_details(orgs)
+        menu_cache['node_details'] = get_node_details(sc, sites, nodes, org_names,
+                                                      uplinks_status, nodes_status)
+    else:
+        active_tunnels = get_items(sc, 'sshtunnel')
+    return list_nodes(menu_cache['node_details'], active_tunnels)
+
+
 def select_node_detail(node):
     """ Print and build dict of uplinks for submenu once site is selected."""
     uplink_list = {}
     print(f"Select how to setup tunnel to {node['name']}")
-    print(f"1 Build SSH tunnel via SteelConnect Manager")
+    print("1 Build SSH tunnel via SteelConnect Manager")
     for index, uplink in enumerate(node['uplinks'], start=2):
         print(f"{index} SSH to {uplink}")
         uplink_list[index] = uplink
@@ -159,19 +295,30 @@ def start_tunnel(sc, index):
     """ Start SCM SSH tunnel to node."""
     print(f"Starting tunnel to: {index['name']}")
     sc.post('sshtunnel/'+index['node_id'])
-    time.sleep(3)
-    tunnel_status = sc.get('sshtunnel/'+index['node_id'])
-    ssh_command = tunnel_status['ssh_help']
+    # poll with exponential backoff instead of always sleeping the
+    # worst-case 3 seconds; a fast SCM has the tunnel up in ~200 ms
+    for delay in (0.1, 0.2, 0.4, 0.8, 1.6, 0):
+        try:
+            tunnel_status = sc.get('sshtunnel/'+index['node_id'])
+        except steelconnection.exceptions.InvalidResource:
+            # tunnel record may 404 right after the POST, keep polling
+            tunnel_status = {}
+        if tunnel_status.get('ssh_help'):
+            break
+        time.sleep(delay)
+    # run ssh directly instead of via a shell; SCM controls ssh_help so
+    # shlex.split reconstructs the intended argv
+    ssh_command = shlex.split(tunnel_status['ssh_help'])
     # change keepalive from 60 to 30 seconds for increased session stability
-    ssh_command = ssh_command.replace("ServerAliveInterval=60", "ServerAliveInterval=30")
+    ssh_command = [arg.replace("ServerAliveInterval=60", "ServerAliveInterval=30")
+                   for arg in ssh_command]
     try:
-        subprocess.run(ssh_command, shell=True)
+        subprocess.run(ssh_command)
     except OSError as error_msg:
-        print(f"Error: {str(error_msg)}")
+        print("Error:", error_msg)
     else:
-        # after SSH session exits, stop tunnel to clean up and show list
+        # after SSH session exits, stop tunnel to clean up
         stop_tunnel(sc, index['node_id'])
-        main(sc)
 
 
 def stop_tunnel(sc, node):
@@ -179,17 +326,16 @@ def stop_tunnel(sc, node):
     sc.delete('sshtunnel/'+node)
 
 
-def start_ssh_direct(sc, ip_addr):
+def start_ssh_direct(ip_addr):
     """ Setup direct SSH connection to node """
     print(f"Connecting via SSH to {ip_addr}")
     # setup SSH connection, with 3 second timeout.
-    ssh_command = "ssh -tt -o ConnectTimeout=3 -o ServerAliveInterval=30 root@" + ip_addr
+    ssh_command = ["ssh", "-tt", "-o", "ConnectTimeout=3",
+                   "-o", "ServerAliveInterval=30", "root@" + ip_addr]
     try:
-        subprocess.run(ssh_command, shell=True)
+        subprocess.run(ssh_command)
     except OSError as error_msg:
-        print(f"Error: {str(error_msg)}")
-    else:
-        main(sc)
+        print("Error:", error_msg)
 
 
 def get_input(prompt, length):
@@ -212,30 +358,35 @@ def get_input(prompt, length):
 @handle_error
 def main(sc=None):
     """ Main function """
-    try:
-        if sc is None:
-            sc = steelconnection.SConnect(SCM_REALM, SCM_USER, SCM_PW)
-    except NameError:
-        sc = steelconnection.SConnect()
-    orgs = get_items(sc, 'orgs')
-    sites = get_items(sc, 'sites')
-    nodes = get_items(sc, 'nodes')
-    uplinks_status = getstatus_items(sc, 'uplinks')
-    nodes_status = getstatus_items(sc, 'nodes')
-    org_details = get_org_details(orgs)
-    node_details = get_node_details(sc, sites, nodes, org_details, uplinks_status, nodes_status)
-    active_tunnels = get_items(sc, 'sshtunnel')
-    nodes_list = list_nodes(node_details, active_tunnels)
+    if sc is None:
+        credentials = load_config()
+        if credentials:
+            sc = steelconnection.SConnect(*credentials)
+        else:
+            print("config.ini file not found, please enter SCM details:")
+            sc = steelconnection.SConnect()
+    # size the session's connection pool for the concurrent fetch below,
+    # so the six parallel GETs reuse kept-alive connections instead of
+    # each paying a fresh TLS handshake; retry transient failures
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=8, pool_maxsize=8,
+        max_retries=requests.adapters.Retry(total=2, backoff_factor=0.2))
+    sc.session.mount('https://', adapter)
+    sc.session.mount('http://', adapter)
+    # rebuild the menu after every SSH session instead of recursing back
+    # into main(); only the tunnel list changes once the menu is built
+    refresh = 'all'
     while True:
+        nodes_list = build_menu(sc, refresh)
+        refresh = 'tunnels'
         selected_site = get_input("Type number to select site, or anything else to quit: ", len(nodes_list))
         uplink_list = select_node_detail(nodes_list[selected_site])
         # adding len+1 as the first index is the manually defined SCM SSH tunnel
         selected_ssh_option = get_input("Selection: ", len(uplink_list)+1)
-        break
-    if selected_ssh_option == 1:
-        start_tunnel(sc, nodes_list[selected_site])
-    else:
-        start_ssh_direct(sc, uplink_list[selected_ssh_option])
+        if selected_ssh_option == 1:
+            start_tunnel(sc, nodes_list[selected_site])
+        else:
+            start_ssh_direct(uplink_list[selected_ssh_option])
 
 
 def signal_handler(sig, frame):